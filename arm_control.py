@@ -3,11 +3,30 @@
 # v 1.1 (c) Neil Polwart 2011
 # class structure Jon Hale 2011
 
-import usb.core, sys, time, optparse, pickle, csv
+import usb.core, sys, time, optparse, csv
+from arm_journal import ArmJournal
 
 class ArmControl:
 
 
+	def __init__(self, resetbase='resetarm'):
+	#	joint positions are persisted in an append-only journal (see
+	#	arm_journal.py) rather than rewritten to resetarm.dat on every move.
+	#	The journal files are only opened once reset data is first used.
+
+		self.resetbase = resetbase
+		self.journal = None
+
+
+	def open_journal(self):
+	#	returns the joint position journal, opening (and recovering) it on first use
+
+		if self.journal is None:
+			self.journal = ArmJournal(self.resetbase)
+
+		return self.journal
+
+
 	def connecttoarm(self):
 	#	connects to the Maplin USB Robotic Arm
 	#	returns Device not found error if unable to connect
@@ -34,28 +53,18 @@ class ArmControl:
 
 
 	def zeroreset(self) :
-		# reset all the values in resetarm.dat to 0
-	
-		resetdata = { 'shoulder':0,'elbow':0,'wrist':0,'grip':0,'rotate':0 }
-		
-		resetfile=open('resetarm.dat','wb')
-		pickle.dump(resetdata, resetfile)
-		resetfile.close()
+		# reset all the stored joint positions to 0
+
+		self.open_journal().reset()
 
 		return
 
 
 	def get_resetdata(self) :
 
-		resetdata={} 				# creates a dictionary
-		resetfile=open('resetarm.dat','rb') 	# opens the resetarm file to read
-	
-		# populate the dictionary resetdata with the contents of the file
+		# returns a dictionary of the stored joint positions
 
-		resetdata = pickle.load(resetfile)
-		resetfile.close() 			# close the file
-	
-		return resetdata
+		return self.open_journal().get_values()
 
 
 	def move_to_reset(self,device, key, direction, wait) :
@@ -70,15 +79,22 @@ class ArmControl:
 	def store_reset_values(self,thedict, resetdata, timedelay) :
 
 		for eachkey in ['shoulder','elbow','wrist','grip','rotate']:
-			if thedict[eachkey] == 1 : resetdata[eachkey]=resetdata[eachkey]+timedelay
-			elif thedict[eachkey] == 2 : resetdata[eachkey]=resetdata[eachkey]-timedelay
-
-		resetfile=open('resetarm.dat','wb')
-		pickle.dump(resetdata, resetfile)
-		resetfile.close()
+			if thedict[eachkey] == 1 : delta=timedelay
+			elif thedict[eachkey] == 2 : delta=-timedelay
+			else : continue
+			resetdata[eachkey]=resetdata[eachkey]+delta
+			self.open_journal().append(eachkey, delta)	# group-committed, not fsync()ed per move
 
 		return resetdata
 
+	def sync_reset_values(self) :
+		# force any batched journal records out to storage, e.g. before shutdown
+
+		if self.journal is not None:
+			self.journal.sync()
+
+		return
+
 	def execute_file(self,filename):
 
 		filehandle=csv.reader(open(filename,'rb'), delimiter=',')	# opens the resetarm file to read
@@ -0,0 +1,326 @@
+# Crash-safe persistence of the arm joint positions used by ArmControl
+#
+# Joint positions are tracked as accumulated motor run times (seconds)
+# per joint. Instead of rewriting a pickle on every move, each move is
+# appended to a small binary journal as fixed size (joint, delta)
+# records. The journal is periodically compacted into a snapshot, and
+# recovery loads the snapshot and replays the journal on top of it.
+#
+# Files (for the default base name 'resetarm'):
+#   resetarm.snap     - snapshot: generation number + one double per joint
+#   resetarm.journal  - header with the snapshot generation, then records
+#
+# Every record is handed to the OS as soon as it is appended, so it
+# survives the process crashing. The fsync() that makes records survive
+# a power cut is done in groups: once group_size records are pending,
+# or at the latest group_interval seconds after the first unsynced
+# record (a background timer takes care of a burst of moves followed by
+# idle time). A power cut therefore loses at most the moves of the last
+# group_interval seconds. Torn or corrupt records at the end of the
+# journal are detected by their checksum and dropped.
+
+import os, shutil, struct, threading, time, zlib, pickle
+
+JOINTS = ['shoulder','elbow','wrist','grip','rotate']
+
+SNAP_MAGIC = b'ARMS'
+JOURNAL_MAGIC = b'ARMJ'
+
+# magic, generation, one double per joint, crc32
+SNAP_FORMAT = '<4sI' + 'd' * len(JOINTS)
+SNAP_SIZE = struct.calcsize(SNAP_FORMAT)
+# magic, generation
+HEADER_FORMAT = '<4sI'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# joint index, delta in seconds, 16 bit checksum
+RECORD_FORMAT = '<BdH'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+def _checksum(data):
+	return zlib.crc32(data) & 0xffff
+
+def _fsync_dir(path):
+	# make a rename() inside path durable
+	try:
+		fd = os.open(path or '.', os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(fd)
+	except OSError:
+		pass
+	os.close(fd)
+
+class ArmJournal:
+
+	def __init__(self, basename='resetarm', group_size=16, group_interval=1.0,
+			compact_records=1024, legacy_file=None):
+	#	basename is used to build the snapshot and journal file names
+	#	group_size and group_interval control how often the journal is fsync()ed
+	#	compact_records is the journal length that triggers a compaction
+	#	legacy_file is a pickled resetdata dictionary imported if no snapshot
+	#	exists, basename + '.dat' by default
+
+		self.snap_file = basename + '.snap'
+		self.journal_file = basename + '.journal'
+		if legacy_file is None:
+			legacy_file = basename + '.dat'
+		self.legacy_file = legacy_file
+		self.group_size = group_size
+		self.group_interval = group_interval
+		self.compact_records = compact_records
+
+		self.generation = 0
+		self.values = dict.fromkeys(JOINTS, 0.0)
+		self.journal = None
+		self.records = 0
+		self.pending = 0
+		self.sync_timer = None
+		# append() and the sync timer run on different threads
+		self.lock = threading.RLock()
+
+		self.recover()
+
+
+	def recover(self) :
+		# load the last snapshot and replay the journal on top of it
+
+		self.lock.acquire()
+		try:
+			return self._recover()
+		finally:
+			self.lock.release()
+
+
+	def _recover(self) :
+
+		self.close()
+		self.generation, self.values = self._read_snapshot()
+		self.records = 0
+		if not os.path.exists(self.snap_file):
+			# first run (or legacy import): give the journal a base to replay onto
+			self._write_snapshot(self.generation, self.values)
+
+		valid_size = 0
+		try:
+			journalfile = open(self.journal_file, 'rb')
+		except IOError:
+			journalfile = None
+
+		if journalfile:
+			header = journalfile.read(HEADER_SIZE)
+			if len(header) == HEADER_SIZE:
+				magic, generation = struct.unpack(HEADER_FORMAT, header)
+				# a journal from the previous generation was already folded
+				# into the snapshot by a compaction that got interrupted.
+				# Any other generation means its snapshot was lost, so the
+				# records can't be replayed; keep them for inspection.
+				if magic == JOURNAL_MAGIC and generation not in (self.generation, self.generation - 1):
+					print "Possible error: %s doesn't match %s, discarding it (saved as %s.bad)" \
+						% (self.journal_file, self.snap_file, self.journal_file)
+					shutil.copyfile(self.journal_file, self.journal_file + '.bad')
+				if magic == JOURNAL_MAGIC and generation == self.generation:
+					valid_size = HEADER_SIZE
+					while True:
+						record = journalfile.read(RECORD_SIZE)
+						if len(record) < RECORD_SIZE:
+							break
+						joint, delta, check = struct.unpack(RECORD_FORMAT, record)
+						if joint >= len(JOINTS) or check != _checksum(record[:-2]):
+							break
+						self.values[JOINTS[joint]] += delta
+						self.records += 1
+						valid_size += RECORD_SIZE
+			journalfile.close()
+
+		if valid_size == 0:
+			self._start_journal()
+		else:
+			# drop any torn record left over from a crash mid write
+			self.journal = open(self.journal_file, 'r+b')
+			self.journal.truncate(valid_size)
+			self.journal.seek(valid_size)
+
+		return self.get_values()
+
+
+	def get_values(self) :
+		# returns a copy of the current joint positions
+
+		return dict(self.values)
+
+
+	def append(self, key, delta) :
+		# record that joint 'key' moved by 'delta' seconds
+
+		if delta == 0:
+			return
+		joint = JOINTS.index(key)
+		record = struct.pack('<Bd', joint, delta)
+
+		self.lock.acquire()
+		try:
+			self.journal.write(record + struct.pack('<H', _checksum(record)))
+			# hand the record to the OS now, only the fsync() is batched
+			self.journal.flush()
+			self.values[key] += delta
+			self.records += 1
+			self.pending += 1
+
+			if self.pending >= self.group_size:
+				self.sync()
+			elif self.sync_timer is None:
+				self.sync_timer = threading.Timer(self.group_interval, self._timed_sync)
+				self.sync_timer.daemon = True
+				self.sync_timer.start()
+			if self.records >= self.compact_records:
+				self.compact()
+		finally:
+			self.lock.release()
+
+		return
+
+
+	def _timed_sync(self) :
+		# runs on the timer thread group_interval seconds after the
+		# first record of a group was appended
+
+		self.lock.acquire()
+		try:
+			self.sync_timer = None
+			if self.pending:
+				self.sync()
+		finally:
+			self.lock.release()
+
+
+	def sync(self) :
+		# group commit: flush all buffered records to storage
+
+		self.lock.acquire()
+		try:
+			if self.sync_timer is not None:
+				self.sync_timer.cancel()
+				self.sync_timer = None
+			if self.journal is not None:
+				self.journal.flush()
+				os.fsync(self.journal.fileno())
+				self.pending = 0
+		finally:
+			self.lock.release()
+
+		return
+
+
+	def compact(self) :
+		# fold the journal into a new snapshot and start an empty journal
+
+		self.lock.acquire()
+		try:
+			self._write_snapshot(self.generation + 1, self.values)
+			self.generation += 1
+			self._start_journal()
+		finally:
+			self.lock.release()
+
+		return
+
+
+	def reset(self, values=None) :
+		# set all joint positions to 0 (or to the given dictionary)
+
+		self.lock.acquire()
+		try:
+			self.values = dict.fromkeys(JOINTS, 0.0)
+			if values:
+				for eachkey in JOINTS:
+					self.values[eachkey] = float(values.get(eachkey, 0))
+			self.compact()
+		finally:
+			self.lock.release()
+
+		return
+
+
+	def close(self) :
+
+		self.lock.acquire()
+		try:
+			if self.journal is not None:
+				self.sync()
+				self.journal.close()
+				self.journal = None
+		finally:
+			self.lock.release()
+
+		return
+
+
+	def _read_snapshot(self) :
+		# returns (generation, values) from the snapshot, the legacy
+		# pickle file, or all zeros if neither is usable
+
+		values = dict.fromkeys(JOINTS, 0.0)
+		try:
+			snapfile = open(self.snap_file, 'rb')
+			data = snapfile.read()
+			snapfile.close()
+		except IOError:
+			data = None
+
+		if data is not None:
+			if len(data) == SNAP_SIZE + 4 and data[:4] == SNAP_MAGIC and \
+					struct.unpack('<I', data[-4:])[0] == zlib.crc32(data[:-4]) & 0xffffffff:
+				fields = struct.unpack(SNAP_FORMAT, data[:-4])
+				return fields[1], dict(zip(JOINTS, fields[2:]))
+			# keep the damaged file around for inspection, and start over
+			# from the legacy file (or zeros) below
+			print "Possible error reading %s, joint positions may be lost (saved as %s.bad)" \
+				% (self.snap_file, self.snap_file)
+			os.rename(self.snap_file, self.snap_file + '.bad')
+
+		if self.legacy_file and os.path.exists(self.legacy_file):
+			try:
+				legacyfile = open(self.legacy_file, 'rb')
+				legacydata = pickle.load(legacyfile)
+				legacyfile.close()
+				for eachkey in JOINTS:
+					values[eachkey] = float(legacydata.get(eachkey, 0))
+			except Exception:
+				print "Possible error reading %s, starting from zero joint positions" \
+					% self.legacy_file
+
+		return 0, values
+
+
+	def _write_snapshot(self, generation, values) :
+		# atomically replace the snapshot: write a temp file, fsync, rename
+
+		self.close()
+		data = struct.pack(SNAP_FORMAT, SNAP_MAGIC, generation,
+			*[values[eachkey] for eachkey in JOINTS])
+		data += struct.pack('<I', zlib.crc32(data) & 0xffffffff)
+
+		tmp_file = self.snap_file + '.tmp'
+		snapfile = open(tmp_file, 'wb')
+		snapfile.write(data)
+		snapfile.flush()
+		os.fsync(snapfile.fileno())
+		snapfile.close()
+		os.rename(tmp_file, self.snap_file)
+		_fsync_dir(os.path.dirname(self.snap_file))
+
+		return
+
+
+	def _start_journal(self) :
+		# truncate the journal down to a header for the current generation
+
+		self.close()
+		self.journal = open(self.journal_file, 'wb')
+		self.journal.write(struct.pack(HEADER_FORMAT, JOURNAL_MAGIC, self.generation))
+		self.sync()
+		_fsync_dir(os.path.dirname(self.journal_file))
+		self.records = 0
+
+		return
@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+#
+# Performance regression benchmarks for minnowboard_fish_picker-upper.py
+#
+# Micro-benchmarks time detect_and_draw(), the per-frame cost of
+# watch_for_fish() and ArmControl.buildcommand() on sample frames. The
+# macro benchmark runs a complete search, center, pick up, put down and
+# return cycle against recorded footage of a base sweep, with a
+# stand-in for the arm's USB device that keeps track of where the base
+# has rotated to, so the script sees the frames it would have seen.
+#
+# Results are written as JSON and compared against a stored baseline.
+# The run fails (exit status 1) if any benchmark's median time is more
+# than --max-slowdown times its baseline, if a benchmark in the baseline
+# didn't run, or if a pick up cycle didn't complete.
+#
+# Sample data lives in benchmark_data/ and is recorded with this
+# script, using your own lighting and fish:
+#
+#   ./benchmark.py --record-frames 20   webcam only
+#   ./benchmark.py --record-sweep       needs the arm, in its calibration position
+#
+# Then run ./benchmark.py --save-baseline once, and ./benchmark.py
+# after every change to compare against it.
+
+import sys, os, time, json, imp, optparse, bisect, signal, tempfile, shutil, platform
+from timeit import default_timer as timer
+
+import cv2.cv as cv
+from arm_control import ArmControl
+from search_planner import SearchPlanner
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+picker = imp.load_source("fish_picker",
+	os.path.join(script_dir, "minnowboard_fish_picker-upper.py"))
+
+#####################################################################
+
+# Stands in for the arm's USB device. Accepts the same control transfers
+# as the real one, and keeps track of how far the base has rotated and
+# whether the grip has closed on the fish.
+class FakeArmDevice:
+
+	def __init__(self, total_rotation_time):
+		self.total_rotation_time = total_rotation_time
+		self.position = 0.0		# seconds left of the calibration position
+		self.rotate = 0
+		self.rotate_marker = time.time()
+		self.grip_open = False
+		self.fish_picked = False
+		self.commands = 0
+
+	def set_configuration(self):
+		return
+
+	def ctrl_transfer(self, bmRequestType, bRequest, wValue, wIndex, data, timeout=None):
+		self.commands += 1
+		self.base_position()
+
+		# ArmControl.sendcommand() sends the string '0,0,0' by default;
+		# treat that, or anything else that isn't three ints from
+		# buildcommand(), as "stop all motors"
+		if isinstance(data, basestring) or len(data) != 3 or \
+				not all(isinstance(byte, int) for byte in data):
+			self.rotate = 0
+			return len(data)
+
+		self.rotate = data[1]
+		grip = data[0] & 3
+		if grip == 2:
+			self.grip_open = True
+		elif grip == 1 and self.grip_open:
+			# closing an open grip picks the fish up
+			self.grip_open = False
+			self.fish_picked = True
+
+		return len(data)
+
+	def base_position(self):
+		now = time.time()
+		elapsed = now - self.rotate_marker
+		self.rotate_marker = now
+
+		if self.rotate == 2:
+			self.position += elapsed
+		elif self.rotate == 1:
+			self.position -= elapsed
+		self.position = min(max(self.position, 0), self.total_rotation_time)
+
+		return self.position
+
+# Replaces the cv module inside the fish picker-upper script: QueryFrame()
+# returns recorded frames in a loop, everything else is passed through to
+# OpenCV. If fps is set, frames are handed out no faster than a webcam
+# would deliver them.
+class FootagePlayer:
+
+	def __init__(self, frames, fps=0):
+		self.frames = frames
+		self.index = 0
+		self.frame_count = 0
+		self.interval = 1.0 / fps if fps else 0
+		self.next_time = 0
+
+	def __getattr__(self, name):
+		return getattr(cv, name)
+
+	def QueryFrame(self, capture):
+		if self.interval:
+			now = time.time()
+			if now < self.next_time:
+				time.sleep(self.next_time - now)
+			self.next_time = max(now, self.next_time) + self.interval
+
+		self.frame_count += 1
+		return self.next_frame()
+
+	def next_frame(self):
+		frame = self.frames[self.index % len(self.frames)]
+		self.index += 1
+		return frame
+
+# Plays back recorded base sweeps: the frame returned is the one
+# recorded closest to the FakeArmDevice's current base position, from
+# the sweep without the fish once it has been picked up.
+class SweepPlayer(FootagePlayer):
+
+	def __init__(self, fish_sweep, empty_sweep, device, fps=30):
+		FootagePlayer.__init__(self, None, fps)
+		self.sweeps = {}
+		for picked, sweep in ((False, fish_sweep), (True, empty_sweep)):
+			self.sweeps[picked] = ([position for position, frame in sweep],
+				[frame for position, frame in sweep])
+		self.device = device
+
+	def next_frame(self):
+		positions, frames = self.sweeps[self.device.fish_picked]
+		position = self.device.base_position()
+		index = bisect.bisect_left(positions, position)
+		if index == len(positions) or (index > 0 and
+				position - positions[index - 1] < positions[index] - position):
+			index -= 1
+		return frames[index]
+
+#####################################################################
+
+def summarize(times):
+	# returns None if there are no samples, e.g. when every sample frame
+	# was skipped
+	if not times:
+		return None
+	times = sorted(times)
+	return {
+		"runs": len(times),
+		"median": times[len(times) // 2],
+		"mean": sum(times) / len(times),
+		"min": times[0],
+		"max": times[-1],
+	}
+
+def load_frames(directory):
+	frames = []
+	if os.path.isdir(directory):
+		for filename in sorted(os.listdir(directory)):
+			if filename.endswith(".jpg"):
+				frames.append(cv.LoadImage(os.path.join(directory, filename),
+					cv.CV_LOAD_IMAGE_COLOR))
+	return frames
+
+def load_sweep(directory):
+	# returns a list of (position, frame) sorted by base position
+	index_fn = os.path.join(directory, "index.json")
+	if not os.path.exists(index_fn):
+		return []
+	index_fd = open(index_fn, "r")
+	index = json.load(index_fd)
+	index_fd.close()
+
+	sweep = [(entry["position"], cv.LoadImage(os.path.join(directory, entry["file"]),
+		cv.CV_LOAD_IMAGE_COLOR)) for entry in index]
+	sweep.sort(key=lambda entry: entry[0])
+	return sweep
+
+def bench_detect_and_draw(frames, repeat):
+	times = []
+	for index in range(repeat * len(frames)):
+		# detect_and_draw() draws on the image, so give it a fresh copy
+		img = cv.CloneImage(frames[index % len(frames)])
+		start = timer()
+		picker.detect_and_draw(img)
+		times.append(timer() - start)
+	return summarize(times)
+
+def bench_copy_frame(frames, repeat):
+	# the frame copy watch_for_fish() makes before detection
+	frame_copy = cv.CreateImage((frames[0].width, frames[0].height),
+		cv.IPL_DEPTH_8U, frames[0].nChannels)
+	times = []
+	for index in range(repeat * len(frames)):
+		frame = frames[index % len(frames)]
+		if (frame.width, frame.height) != (frame_copy.width, frame_copy.height):
+			continue
+		start = timer()
+		cv.Copy(frame, frame_copy)
+		times.append(timer() - start)
+	return summarize(times)
+
+def bench_watch_for_fish(frames, repeat):
+	# average time per frame of watch_for_fish() without returning on
+	# detection, with frames available immediately
+	player = FootagePlayer(frames)
+	picker.cv = player
+	times = []
+	try:
+		for index in range(repeat):
+			player.frame_count = 0
+			start = timer()
+			picker.watch_for_fish(0.5, False)
+			times.append((timer() - start) / max(player.frame_count, 1))
+	finally:
+		picker.cv = cv
+	return summarize(times)
+
+def bench_buildcommand(repeat, calls=1000):
+	workdir = tempfile.mkdtemp(prefix="fish_benchmark_")
+	arm = ArmControl(os.path.join(workdir, "resetarm"))
+	times = []
+	for index in range(repeat):
+		start = timer()
+		for call in range(calls):
+			arm.buildcommand(0, 2, 0, 0, 1, 0)
+		times.append((timer() - start) / calls)
+	shutil.rmtree(workdir)
+	return summarize(times)
+
+class CycleTimeout(Exception):
+	pass
+
+def bench_cycle(fish_sweep, empty_sweep, cycles, timeout, fps):
+	# full search, center, pick up, put down and return cycle against
+	# the recorded sweeps, starting from the calibration position.
+	# Returns (results of the completed cycles, True if all completed).
+	results = { "cycle": [], "cycle.time_to_first_detection": [], "cycle.per_frame": [] }
+	completed = True
+	workdir = tempfile.mkdtemp(prefix="fish_benchmark_")
+
+	def on_timeout(signum, frame):
+		raise CycleTimeout()
+	old_handler = signal.signal(signal.SIGALRM, on_timeout)
+
+	try:
+		for index in range(cycles):
+			device = FakeArmDevice(picker.total_rotation_time)
+			player = SweepPlayer(fish_sweep, empty_sweep, device, fps)
+			picker.cv = player
+			picker.arm = ArmControl(os.path.join(workdir, "resetarm"))
+			picker.dev = device
+			picker.rotation_time_left = picker.total_rotation_time
+			picker.rotation_time_right = 0
+			picker.rotation_direction = ""
+			# fresh prior file for every cycle, so the expected detection
+			# time and the real search_prior.json aren't affected
+			planner = SearchPlanner(picker.total_rotation_time,
+				os.path.join(workdir, "search_prior_%d.json" % index))
+
+			signal.alarm(timeout)
+			start = timer()
+			detection_time = picker.search_and_pick_up(planner)
+			elapsed = timer() - start
+			signal.alarm(0)
+
+			if detection_time is None:
+				print "*** Cycle %d found no fish - is there a fish in the recorded sweep?" % (index + 1)
+				completed = False
+				break
+			results["cycle"].append(elapsed)
+			results["cycle.time_to_first_detection"].append(detection_time)
+			results["cycle.per_frame"].append(elapsed / max(player.frame_count, 1))
+	except CycleTimeout:
+		print "*** Cycle %d did not complete within %d seconds" % (index + 1, timeout)
+		completed = False
+	finally:
+		signal.alarm(0)
+		signal.signal(signal.SIGALRM, old_handler)
+		picker.cv = cv
+		shutil.rmtree(workdir)
+
+	return (dict((name, summarize(times)) for name, times in results.items() if times),
+		completed)
+
+def compare(results, baseline, max_slowdown, skipped=()):
+	# returns the names of the benchmarks that got too slow, or that are
+	# in the baseline but missing from the results (apart from those
+	# starting with one of the skipped prefixes)
+	failures = []
+	for name in sorted(baseline):
+		if name not in results and not name.startswith(tuple(skipped)):
+			print "  %-32s %13s   *** MISSING" % (name, "-")
+			failures.append(name)
+
+	for name in sorted(results):
+		median = results[name]["median"]
+		if name not in baseline:
+			print "  %-32s %12.6fs   (no baseline)" % (name, median)
+			continue
+		ratio = median / baseline[name]["median"]
+		flag = ""
+		if ratio > max_slowdown:
+			flag = "  *** SLOWER"
+			failures.append(name)
+		print "  %-32s %12.6fs   %5.2fx baseline%s" % (name, median, ratio, flag)
+	return failures
+
+#####################################################################
+
+def record_frames(frames_dir, num_frames):
+	if not os.path.isdir(frames_dir):
+		os.makedirs(frames_dir)
+	capture = cv.CreateCameraCapture(picker.WebcamNum)
+	for index in range(5):
+		cv.QueryFrame(capture)
+
+	for index in range(num_frames):
+		frame = cv.QueryFrame(capture)
+		cv.SaveImage(os.path.join(frames_dir, "%04d.jpg" % index), frame)
+		time.sleep(0.5)
+	print "Saved", num_frames, "frames to", frames_dir
+
+def record_sweep(sweep_dirs):
+	# Rotates the base all the way left while saving frames, then back.
+	# Done twice: once with a fish in view, once without it.
+	arm = ArmControl()
+	dev = arm.connecttoarm()
+	capture = cv.CreateCameraCapture(picker.WebcamNum)
+
+	for directory, prompt in zip(sweep_dirs, ("Place a fish for the arm to find",
+			"Remove the fish")):
+		raw_input(prompt + ", then press Enter ")
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		for index in range(5):
+			cv.QueryFrame(capture)
+
+		index = []
+		arm.sendcommand(dev, arm.buildcommand(0,0,0,0,2))
+		start = time.time()
+		while time.time() - start < picker.total_rotation_time:
+			frame = cv.QueryFrame(capture)
+			position = time.time() - start
+			filename = "%04d.jpg" % len(index)
+			cv.SaveImage(os.path.join(directory, filename), frame)
+			index.append({ "file": filename, "position": position })
+		arm.sendcommand(dev)
+
+		index_fd = open(os.path.join(directory, "index.json"), "w")
+		json.dump(index, index_fd, indent=1)
+		index_fd.close()
+
+		arm.sendcommand(dev, arm.buildcommand(0,0,0,0,1))
+		time.sleep(picker.total_rotation_time)
+		arm.sendcommand(dev)
+		print "Saved", len(index), "frames to", directory
+
+#####################################################################
+
+def main():
+	parser = optparse.OptionParser()
+	parser.add_option("--data-dir", default=os.path.join(script_dir, "benchmark_data"),
+		help="directory with the recorded frames and baseline")
+	parser.add_option("--output", default="benchmark_results.json",
+		help="where to write the results")
+	parser.add_option("--baseline", default=None,
+		help="baseline results to compare against (default DATA_DIR/baseline.json)")
+	parser.add_option("--save-baseline", action="store_true",
+		help="store these results as the new baseline")
+	parser.add_option("--max-slowdown", type="float", default=1.25,
+		help="fail if a benchmark is slower than this many times its baseline")
+	parser.add_option("--repeat", type="int", default=10,
+		help="number of runs of each micro-benchmark")
+	parser.add_option("--micro-only", action="store_true",
+		help="skip the full pick up cycle")
+	parser.add_option("--cycles", type="int", default=1,
+		help="number of full pick up cycles to run")
+	parser.add_option("--cycle-timeout", type="int", default=300,
+		help="seconds before a pick up cycle is considered stuck")
+	parser.add_option("--fps", type="float", default=30,
+		help="webcam frame rate to play back the recorded sweeps at")
+	parser.add_option("--haar-db", default=picker.haar_dbfile,
+		help="haar cascade classifier file")
+	parser.add_option("--record-frames", type="int", default=0,
+		help="save this many sample frames from the webcam and exit")
+	parser.add_option("--record-sweep", action="store_true",
+		help="record base sweeps with and without a fish and exit")
+	(options, args) = parser.parse_args()
+	if options.repeat < 1:
+		parser.error("--repeat must be at least 1")
+	if options.cycles < 1:
+		parser.error("--cycles must be at least 1")
+
+	frames_dir = os.path.join(options.data_dir, "frames")
+	sweep_dirs = (os.path.join(options.data_dir, "sweep_fish"),
+		os.path.join(options.data_dir, "sweep_empty"))
+	baseline_fn = options.baseline or os.path.join(options.data_dir, "baseline.json")
+
+	if options.record_frames:
+		record_frames(frames_dir, options.record_frames)
+		return 0
+	if options.record_sweep:
+		record_sweep(sweep_dirs)
+		return 0
+
+	picker.cascade = cv.Load(options.haar_db)
+	if not picker.cascade:
+		print "Error loading cascade classifier db", options.haar_db
+		return 1
+	picker.use_highgui_window = False
+
+	results = {}
+	cycle_completed = True
+	results["ArmControl.buildcommand"] = bench_buildcommand(options.repeat)
+
+	frames = load_frames(frames_dir)
+	if frames:
+		# don't count the pause between displayed frames
+		waitkey_resolution = picker.waitkey_resolution
+		picker.waitkey_resolution = 0
+		results["detect_and_draw"] = bench_detect_and_draw(frames, options.repeat)
+		results["watch_for_fish.copy_frame"] = bench_copy_frame(frames, options.repeat)
+		results["watch_for_fish.per_frame"] = bench_watch_for_fish(frames, options.repeat)
+		picker.waitkey_resolution = waitkey_resolution
+	else:
+		print "No sample frames in", frames_dir, "- skipping frame benchmarks"
+
+	if not options.micro_only:
+		fish_sweep = load_sweep(sweep_dirs[0])
+		empty_sweep = load_sweep(sweep_dirs[1])
+		if fish_sweep and empty_sweep:
+			cycle_results, cycle_completed = bench_cycle(fish_sweep, empty_sweep,
+				options.cycles, options.cycle_timeout, options.fps)
+			results.update(cycle_results)
+		else:
+			print "No recorded sweeps in", options.data_dir, "- skipping pick up cycle"
+
+	# drop benchmarks that produced no samples
+	results = dict((name, result) for name, result in results.items() if result)
+
+	output = {
+		"created": time.strftime("%Y-%m-%d %H:%M:%S"),
+		"platform": platform.platform(),
+		"settings": {
+			"image_scale": picker.image_scale,
+			"haar_scale": picker.haar_scale,
+			"min_neighbors": picker.min_neighbors,
+			"min_size": picker.min_size,
+		},
+		"benchmarks": results,
+	}
+	output_fd = open(options.output, "w")
+	json.dump(output, output_fd, indent=1, sort_keys=True)
+	output_fd.close()
+
+	if options.save_baseline:
+		if not cycle_completed:
+			print "Not saving a baseline from an incomplete pick up cycle"
+			return 1
+		shutil.copyfile(options.output, baseline_fn)
+		print "Saved baseline to", baseline_fn
+
+	baseline = {}
+	if os.path.exists(baseline_fn):
+		baseline_fd = open(baseline_fn, "r")
+		baseline = json.load(baseline_fd)["benchmarks"]
+		baseline_fd.close()
+
+	print "Median times (results in %s):" % options.output
+	skipped = []
+	if options.micro_only:
+		skipped.append("cycle")
+	failures = compare(results, baseline, options.max_slowdown, skipped)
+	if failures:
+		print "%d benchmark(s) missing or more than %.2fx slower than the baseline: %s" % (
+			len(failures), options.max_slowdown, ", ".join(failures))
+		return 1
+	if not cycle_completed:
+		print "The pick up cycle did not complete"
+		return 1
+
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
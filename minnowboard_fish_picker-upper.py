@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
-import sys,time
+import sys,time,socket
 from arm_control import ArmControl
+from preview_server import PreviewServer
+from search_planner import SearchPlanner
 
 import cv2.cv as cv
 
@@ -13,6 +15,23 @@ WebcamNum = 0
 waitkey_resolution = 50 # ms
 window_title = "MinnowBoard Fish Picker-Upper"
 
+# Displaying the HighGUI window needs a local X display and costs CPU
+# that object detection could use. Set this to False to run headless
+# and watch the preview server stream instead.
+use_highgui_window = True
+
+# MJPEG-over-HTTP preview server. Browse to http://localhost:8080/ for
+# the annotated video stream, or /status for the current detections and
+# arm state as JSON. Set preview_port to 0 to disable it. Frames are
+# only encoded while someone is watching.
+preview_port = 8080
+# The server has no authentication, so it only listens on localhost by
+# default. Set this to "" to allow other machines on the network to
+# connect, e.g. to watch from a laptop.
+preview_host = "127.0.0.1"
+preview_size = (320, 240)
+preview_max_fps = 10 # 0 for no frame rate cap
+
 # Amount of time it takes to completely rotate the robot arm's base
 total_rotation_time = 15 # seconds (no, it's really 16.5s)
 # The arm starts in the rightmost rotated position
@@ -20,6 +39,8 @@ rotation_time_left = total_rotation_time
 rotation_time_right = 0
 rotation_direction = ""
 rotation_time_marker = 0
+# What the arm is currently doing, reported by the preview server
+arm_state = "idle"
 
 # Parameters for haar detection
 # From the API:
@@ -106,6 +127,7 @@ def watch_for_fish(time_limit, return_when_found=True):
 # Based on the facedetect.py code example
 def detect_and_draw(img):
 	global cv, cascade, haar_scale, min_neighbors, haar_flags, min_size
+	global last_detections
 
 	# allocate temporary images
 	gray = cv.CreateImage((img.width,img.height), 8, 1)
@@ -124,6 +146,7 @@ def detect_and_draw(img):
 		fish = cv.HaarDetectObjects(small_img, cascade, cv.CreateMemStorage(0),
 			haar_scale, min_neighbors, haar_flags, min_size)
 
+	last_detections = []
 	if fish:
 		# fish is now a list of rectangles
 		for ((x, y, w, h), n) in fish:
@@ -133,17 +156,36 @@ def detect_and_draw(img):
 			pt2 = (int((x + w) * image_scale), int((y + h) * image_scale))
 			#print "Rectangle width is", pt2[0] - pt1[0]
 			cv.Rectangle(img, pt1, pt2, cv.RGB(255, 0, 0), 3, 8, 0)
+			last_detections.append([pt1[0], pt1[1], pt2[0], pt2[1]])
+
+	if preview:
+		preview.publish(img)
 
-	cv.ShowImage(window_title, img)
-	cv.WaitKey(waitkey_resolution)
+	if use_highgui_window:
+		cv.ShowImage(window_title, img)
+		cv.WaitKey(waitkey_resolution)
+	else:
+		time.sleep(waitkey_resolution / 1000.0)
 
 	if fish:
 		return pt1
 	else:
 		return False
 
+# Returns the dictionary served by the preview server's /status page
+def preview_status():
+	return {
+		"detections": last_detections,
+		"arm_state": arm_state,
+		"rotation_direction": rotation_direction,
+		"rotation_time_left": rotation_time_left,
+		"rotation_time_right": rotation_time_right,
+	}
+
 def center_on_fish():
-	global centered_fish_coord, rotation_direction
+	global centered_fish_coord, rotation_direction, arm_state
+
+	arm_state = "centering"
 
 	movement_steps = 0.1 # second
 
@@ -181,29 +223,34 @@ def center_on_fish():
 
 def rotate_base_left():
 	print "Rotating base to the left"
-	global rotation_time_marker, rotation_direction
+	global rotation_time_marker, rotation_direction, arm_state
 	rotation_direction = "left"
+	arm_state = "rotating left"
 	rotation_time_marker = time.time()
 	cmd = arm.buildcommand(0,0,0,0,2)
 	arm.sendcommand(dev,cmd)
 
 def rotate_base_right():
 	print "Rotating base to the right"
-	global rotation_time_marker, rotation_direction
+	global rotation_time_marker, rotation_direction, arm_state
 	rotation_direction = "right"
+	arm_state = "rotating right"
 	rotation_time_marker = time.time()
 	cmd = arm.buildcommand(0,0,0,0,1)
 	arm.sendcommand(dev,cmd)
 
 def stop_base_rotation():
 	print "Stopping base rotation"
-	global rotation_time_marker, rotation_time_left, rotation_time_right
+	global rotation_time_marker, rotation_time_left, rotation_time_right, arm_state
 	arm.sendcommand(dev)
+	arm_state = "stopped"
 
 	now = time.time()
 	elapsed_time = now - rotation_time_marker
 
-	if elapsed_time > total_rotation_time:
+	# Allow a little slack for watch_for_fish() overshooting the end of
+	# a full sweep by a frame or two
+	if elapsed_time > total_rotation_time + 1:
 		# This can happen when retrying pick-ups, so don't update
 		# the rotation time variables
 		return
@@ -212,13 +259,16 @@ def stop_base_rotation():
 		rotation_time_left = rotation_time_left - elapsed_time
 	else:
 		rotation_time_left = rotation_time_left + elapsed_time
+	rotation_time_left = min(max(rotation_time_left, 0), total_rotation_time)
 	rotation_time_right = total_rotation_time - rotation_time_left
 	watch_for_fish(1)
 
 # Timing values produced by trial and error - these worked for picking
 # up a fish located six inches from the outer edge of the OWI robot base.
 def pick_up():
+	global arm_state
 	print "Picking up fish"
+	arm_state = "picking up"
 
 	# Don't run watch_for_fish() immediately so the last object
 	# detection ROI appears on the screen, and the operator can
@@ -264,7 +314,9 @@ def pick_up():
 	watch_for_fish(0.5, False)
 
 def undo_pick_up():
+	global arm_state
 	print "Undo-ing pick up"
+	arm_state = "undoing pick up"
 
 	# Elbow up
 	cmd = arm.buildcommand(0,1,0,0,0)
@@ -298,7 +350,9 @@ def move_to_plate():
 	stop_base_rotation()
 
 def put_down():
+	global arm_state
 	print "Putting down fish"
+	arm_state = "putting down"
 
 	# Elbow down
 	cmd = arm.buildcommand(0,2,0,0,0)
@@ -313,9 +367,10 @@ def put_down():
 	arm.sendcommand(dev)
 
 def return_to_calibration_position():
-	global rotation_time_right
+	global rotation_time_right, arm_state
 
 	print "Returning to calibration position"
+	arm_state = "returning to calibration position"
 
 	# Shoulder up
 	cmd = arm.buildcommand(1,0,0,0,0)
@@ -356,61 +411,109 @@ def pick_up_fish():
 		undo_pick_up()
 		pick_up_fish()
 		
+# Sweep the base over its whole range once, and give up if no fish was
+# seen by the end of the sweep.
+# If a fish is found, pick it up, put it down on the plate and return
+# to the calibration position. Returns the number of seconds it took
+# to first detect the fish, or None if no fish was found.
+def search_and_pick_up(planner):
+	# rotation_time_right is how far left of the calibration position
+	# the base currently is
+	search_start = time.time()
+	fish_coord = 0
+
+	for direction, duration in planner.plan(rotation_time_right):
+		if direction == "left":
+			rotate_base_left()
+		else:
+			rotate_base_right()
+		fish_coord = watch_for_fish(duration)
+		if fish_coord > 0:
+			break
+		stop_base_rotation()
+
+	if fish_coord <= 0:
+		planner.report(None)
+		print "Giving up, returning to calibration position"
+		if rotation_time_right > 0:
+			rotate_base_right()
+			watch_for_fish(rotation_time_right - 0.6, False)
+			stop_base_rotation()
+		return None
+
+	detection_time = time.time() - search_start
+	planner.report(detection_time)
+	pick_up_fish()
+	planner.record_found(rotation_time_right)
+	move_to_plate()
+	planner.record_placed(rotation_time_right)
+	planner.save()
+	put_down()
+	return_to_calibration_position()
+	return detection_time
+
+# Set up by the main program below, or by benchmark.py
+arm = None
+dev = None
+cascade = None
+capture = None
+preview = None
+last_detections = []
+
 # main:
 
-# OWI robot arm setup
-arm = ArmControl()
-dev = arm.connecttoarm()
-
-cascade = cv.Load(haar_dbfile)
-if not cascade:
-	print "Error loading cascade classifier db", haar_dbfile
-	exit(1)
-
-# Capture video stream from webcam
-capture = cv.CreateCameraCapture(WebcamNum)
-cv.NamedWindow(window_title, 1)
-
-# Ensure the video stream is visible before starting base rotation
-watch_for_fish(1)
-
-# I should really use one of the GPIO libraries for this, but
-# it's late and I need to demo this in the morning:
-# GPIO pin 5 corresponds to gpio246                    
-gpio_direction_fn = "/sys/class/gpio/gpio246/direction"
-gpio_value_fn = "/sys/class/gpio/gpio246/value"
-                                           
-# Set up GPIO pin as an input:             
-direction_fd = open(gpio_direction_fn, 'w')
-direction_fd.write("in")
-
-while True:
-	value_fd = open(gpio_value_fn, 'r')
-	val = value_fd.readline()
-	if val == "1\n":
-		break
-	value_fd.close()
-	watch_for_fish(0.05)
-
-while True:
-	rotate_base_left()
-	fish_coord = watch_for_fish(rotation_time_left)
-	if fish_coord > 0:
-		pick_up_fish()
-		move_to_plate()
-		put_down()
-		return_to_calibration_position()
-		break
+if __name__ == "__main__":
+	# OWI robot arm setup
+	arm = ArmControl()
+	dev = arm.connecttoarm()
+
+	cascade = cv.Load(haar_dbfile)
+	if not cascade:
+		print "Error loading cascade classifier db", haar_dbfile
+		exit(1)
+
+	# Capture video stream from webcam
+	capture = cv.CreateCameraCapture(WebcamNum)
+	if use_highgui_window:
+		cv.NamedWindow(window_title, 1)
+
+	if preview_port:
+		try:
+			preview = PreviewServer(preview_port, preview_host, preview_size,
+				preview_max_fps, status_callback=preview_status, title=window_title)
+			preview.start()
+			print "Preview server running on port", preview_port
+		except socket.error as e:
+			# the preview is optional, so don't stop the demo over it
+			print "*** WARNING *** Could not start preview server on port", preview_port, "-", e
+			preview = None
+
+	# Ensure the video stream is visible before starting base rotation
+	watch_for_fish(1)
 
-	stop_base_rotation()
-	rotate_base_right()
-	fish_coord = watch_for_fish(rotation_time_right)
-	if fish_coord > 0:
-		pick_up_fish()
-		move_to_plate()
-		put_down()
-		return_to_calibration_position()
-		break
-	stop_base_rotation()
+	# I should really use one of the GPIO libraries for this, but
+	# it's late and I need to demo this in the morning:
+	# GPIO pin 5 corresponds to gpio246
+	gpio_direction_fn = "/sys/class/gpio/gpio246/direction"
+	gpio_value_fn = "/sys/class/gpio/gpio246/value"
+
+	# Set up GPIO pin as an input:
+	direction_fd = open(gpio_direction_fn, 'w')
+	direction_fd.write("in")
+
+	while True:
+		value_fd = open(gpio_value_fn, 'r')
+		val = value_fd.readline()
+		if val == "1\n":
+			break
+		value_fd.close()
+		watch_for_fish(0.05)
+
+	search_and_pick_up(SearchPlanner(total_rotation_time))
 
-cv.DestroyWindow(window_title)
+	arm_state = "done"
+	arm.sync_reset_values()
+	if preview:
+		preview.stop()
+	if use_highgui_window:
+		cv.DestroyWindow(window_title)
@@ -0,0 +1,242 @@
+# MJPEG-over-HTTP preview of the annotated webcam stream
+#
+# An alternative to the HighGUI window for running the demo headless.
+# Point a browser at http://localhost:<port>/ to watch the object
+# detection stream, or fetch /status for a JSON summary of the current
+# detections and arm state.
+#
+# Frames are only shrunk and JPEG encoded while at least one client is
+# watching /stream, the encoding happens in a background thread, and
+# the published frame rate is capped. Every client is always sent the
+# newest encoded frame, so a slow client simply skips frames instead of
+# holding up detection or the other clients.
+
+import json, socket, sys, threading, time
+
+try:
+	import BaseHTTPServer, SocketServer
+except ImportError:
+	import http.server as BaseHTTPServer
+	import socketserver as SocketServer
+
+import cv2.cv as cv
+
+BOUNDARY = "fishframe"
+
+INDEX_PAGE = """<html>
+<head><title>%s</title></head>
+<body style="background: #000; color: #fff; font-family: sans-serif">
+<img src="/stream"><br>
+<a href="/status" style="color: #fff">status</a>
+</body>
+</html>
+"""
+
+class PreviewServer:
+
+	def __init__(self, port=8080, host="127.0.0.1", size=(320, 240), max_fps=10,
+			quality=70, status_callback=None, title="Preview"):
+	#	host/port is the address to listen on (localhost only by default,
+	#	"" listens on all interfaces)
+	#	size is the (width, height) frames are shrunk to before encoding
+	#	max_fps caps how often frames are published to clients (0 for no cap)
+	#	quality is the JPEG quality, 0-100
+	#	status_callback returns a dictionary which is served as /status
+
+		self.size = size
+		if max_fps:
+			self.min_interval = 1.0 / max_fps
+		else:
+			self.min_interval = 0
+		self.quality = quality
+		self.status_callback = status_callback
+		self.title = title
+
+		self.clients = 0
+		self.lock = threading.Condition()
+		self.small_img = cv.CreateImage(size, cv.IPL_DEPTH_8U, 3)
+		self.frame_pending = False	# small_img holds a frame to encode
+		self.jpeg = None		# latest encoded frame
+		self.sequence = 0		# bumped every time jpeg changes
+		self.last_publish = 0
+		self.running = False
+
+		self.httpd = _PreviewHTTPServer((host, port), _PreviewHandler)
+		self.httpd.preview = self
+
+
+	def start(self):
+		# start the HTTP and encoder threads in the background
+
+		self.running = True
+		for target in (self.httpd.serve_forever, self._encode_loop):
+			thread = threading.Thread(target=target)
+			thread.daemon = True
+			thread.start()
+
+
+	def stop(self):
+
+		self.lock.acquire()
+		self.running = False
+		self.lock.notifyAll()
+		self.lock.release()
+		self.httpd.shutdown()
+
+
+	def publish(self, img):
+		# Hand over an annotated frame. This returns immediately if nobody
+		# is watching or the frame rate cap has been reached, otherwise it
+		# only shrinks the frame - encoding happens in the encoder thread.
+
+		if not self.clients:
+			return
+
+		now = time.time()
+		if now - self.last_publish < self.min_interval:
+			return
+		self.last_publish = now
+
+		self.lock.acquire()
+		# if the encoder hasn't picked up the previous frame yet, it is
+		# simply overwritten (dropped)
+		cv.Resize(img, self.small_img, cv.CV_INTER_LINEAR)
+		self.frame_pending = True
+		self.lock.notifyAll()
+		self.lock.release()
+
+
+	def _encode_loop(self):
+
+		while True:
+			self.lock.acquire()
+			while self.running and not self.frame_pending:
+				self.lock.wait()
+			if not self.running:
+				self.lock.release()
+				return
+			# encode outside the lock into a private copy so publish()
+			# never waits on the JPEG encoder
+			frame = cv.CloneImage(self.small_img)
+			self.frame_pending = False
+			self.lock.release()
+
+			jpeg = cv.EncodeImage(".jpg", frame,
+				[cv.CV_IMWRITE_JPEG_QUALITY, self.quality]).tostring()
+
+			self.lock.acquire()
+			self.jpeg = jpeg
+			self.sequence += 1
+			self.lock.notifyAll()
+			self.lock.release()
+
+
+	def _wait_for_frame(self, last_sequence):
+		# block until a frame newer than last_sequence is encoded and
+		# return (sequence, jpeg), or (last_sequence, None) on shutdown
+
+		self.lock.acquire()
+		while self.running and self.sequence == last_sequence:
+			self.lock.wait(1.0)
+		result = (self.sequence, self.jpeg)
+		self.lock.release()
+
+		if not self.running:
+			return (last_sequence, None)
+		return result
+
+
+	def _client_connected(self, delta):
+
+		self.lock.acquire()
+		self.clients += delta
+		sequence = self.sequence
+		self.lock.release()
+
+		# new clients wait for a fresh frame rather than a stale one
+		return sequence
+
+
+	def _status(self):
+
+		if self.status_callback:
+			status = self.status_callback()
+		else:
+			status = {}
+		status["preview_clients"] = self.clients
+		return status
+
+class _PreviewHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def handle_error(self, request, client_address):
+		# a viewer closing the page mid-response is routine, so don't
+		# print a traceback to the demo console for it
+		if isinstance(sys.exc_info()[1], (socket.error, IOError)):
+			return
+		BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class _PreviewHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		preview = self.server.preview
+		path = self.path.split("?")[0]
+
+		if path == "/":
+			self._send(200, "text/html", INDEX_PAGE % preview.title)
+		elif path == "/status":
+			self._send(200, "application/json", json.dumps(preview._status()))
+		elif path == "/stream":
+			self._stream(preview)
+		else:
+			self._send(404, "text/plain", "Not found\n")
+
+
+	def _send(self, code, content_type, body):
+		body = body.encode("utf-8")
+		self.send_response(code)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.send_header("Cache-Control", "no-cache")
+		self.end_headers()
+		self.wfile.write(body)
+
+
+	def _stream(self, preview):
+		self.send_response(200)
+		self.send_header("Content-Type",
+			"multipart/x-mixed-replace; boundary=" + BOUNDARY)
+		self.send_header("Cache-Control", "no-cache")
+		self.end_headers()
+
+		sequence = preview._client_connected(1)
+		try:
+			while True:
+				sequence, jpeg = preview._wait_for_frame(sequence)
+				if jpeg is None:
+					break
+				# a slow client blocks here while newer frames replace
+				# jpeg, so it only ever gets sent the latest one
+				self.wfile.write(("--%s\r\nContent-Type: image/jpeg\r\n"
+					"Content-Length: %d\r\n\r\n" % (BOUNDARY, len(jpeg))).encode("ascii"))
+				self.wfile.write(jpeg)
+				self.wfile.write(b"\r\n")
+		except Exception:
+			# client went away
+			pass
+		finally:
+			preview._client_connected(-1)
+
+
+	def finish(self):
+		# flushing the response fails if the viewer already went away
+		try:
+			BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+		except (socket.error, IOError):
+			pass
+
+
+	def log_message(self, format, *args):
+		# keep the console output for arm and detection messages
+		return
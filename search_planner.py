@@ -0,0 +1,179 @@
+# Bounded base rotation search and time-to-detection estimate
+#
+# Base positions are measured the same way the main script tracks them:
+# in seconds of counterclockwise (left) rotation away from the
+# calibration position, from 0 to total_rotation_time.
+#
+# A search sweeps the base over the whole range exactly once and then
+# gives up, so it always ends. The camera watches the whole time the
+# base rotates and the base can only rotate at one speed, so from the
+# calibration position (where every search starts) that single sweep
+# already reaches every position as early as possible. Remembering where
+# fish were found can't make it any faster, so it isn't used to change
+# the motion.
+#
+# What the planner does remember is a histogram of the base positions
+# where fish were found (and put down) over past runs, stored in
+# search_prior.json. Older runs fade out by multiplying the histogram by
+# decay each time a new position is recorded. The histogram is used to
+# estimate how long the sweep should take to first detect a fish, which
+# is reported next to the actual time.
+
+import json, os
+
+class SearchPlanner:
+
+	def __init__(self, total_rotation_time, prior_file="search_prior.json",
+			bin_time=1.0, decay=0.8, stop_overhead=1.0):
+	#	total_rotation_time is the full base rotation range in seconds
+	#	prior_file stores the histogram between runs
+	#	bin_time is the width of a histogram bin in seconds
+	#	decay is applied to the whole histogram each time a position is recorded
+	#	stop_overhead is the time spent watching after each stop_base_rotation()
+
+		self.total_rotation_time = total_rotation_time
+		self.prior_file = prior_file
+		self.num_bins = max(1, int(round(total_rotation_time / bin_time)))
+		self.bin_time = float(total_rotation_time) / self.num_bins
+		self.decay = decay
+		self.stop_overhead = stop_overhead
+
+		self.bins = [0.0] * self.num_bins
+		self.expected_time = None
+		self.load()
+
+
+	def load(self):
+		# read the histogram, ignoring it if it was made for a different range
+
+		try:
+			priorfile = open(self.prior_file, "r")
+			prior = json.load(priorfile)
+			priorfile.close()
+		except (IOError, ValueError):
+			return
+
+		if prior.get("total_rotation_time") == self.total_rotation_time and \
+				len(prior.get("bins", [])) == self.num_bins:
+			self.bins = [float(value) for value in prior["bins"]]
+
+
+	def save(self):
+		# write to a temporary file and rename so a crash can't leave a
+		# half written prior behind
+
+		tmp_file = self.prior_file + ".tmp"
+		priorfile = open(tmp_file, "w")
+		json.dump({ "total_rotation_time": self.total_rotation_time,
+			"bins": self.bins }, priorfile)
+		priorfile.close()
+		os.rename(tmp_file, self.prior_file)
+
+
+	def record_found(self, position):
+		# a fish was found (and centered on) at this base position
+		self._record(position, 1.0)
+
+
+	def record_placed(self, position):
+		# a fish was put down here, so it may be picked up here next time
+		self._record(position, 0.5)
+
+
+	def _record(self, position, weight):
+		self.bins = [value * self.decay for value in self.bins]
+		self.bins[self._bin(position)] += weight
+
+
+	def _bin(self, position):
+		index = int(position / self.bin_time)
+		return min(max(index, 0), self.num_bins - 1)
+
+
+	def probabilities(self):
+		# returns the normalised histogram, uniform if there is no history
+
+		total = sum(self.bins)
+		if total <= 0:
+			return [1.0 / self.num_bins] * self.num_bins
+		return [value / total for value in self.bins]
+
+
+	def plan(self, position):
+		# Returns the sweeps to make from the given base position as a list
+		# of (direction, seconds) tuples, with direction "left" or "right":
+		# to the nearer end of the range, then to the other end. From the
+		# calibration position this is a single sweep left. If no fish is
+		# found by the end of it, the search should give up.
+
+		if position <= self.total_rotation_time - position:
+			ends = ("right", position), ("left", self.total_rotation_time)
+		else:
+			ends = ("left", self.total_rotation_time - position), ("right", self.total_rotation_time)
+		legs = [(direction, duration) for direction, duration in ends if duration > 0.05]
+
+		self.expected_time = self._expected_time(position, legs)
+		return legs
+
+
+	def _expected_time(self, position, legs):
+		# expected seconds until the sweep first passes over the fish,
+		# weighting each bin by its probability
+
+		probs = self.probabilities()
+		first_seen = [None] * self.num_bins
+		elapsed = 0.0
+		for direction, duration in legs:
+			step = duration if direction == "left" else -duration
+			for index in range(self.num_bins):
+				center = (index + 0.5) * self.bin_time
+				if first_seen[index] is None and \
+						min(position, position + step) <= center <= max(position, position + step):
+					first_seen[index] = elapsed + abs(center - position)
+			position += step
+			elapsed += duration + self.stop_overhead
+
+		return sum(prob * (seen if seen is not None else elapsed)
+			for prob, seen in zip(probs, first_seen))
+
+
+	def report(self, actual_time):
+		# print how the last plan's expected time to first detection
+		# compares to what happened; actual_time is None if nothing was found
+
+		if self.expected_time is None:
+			return
+		if actual_time is None:
+			print "No fish found after a full sweep (expected first detection after %.1fs)" \
+				% self.expected_time
+		else:
+			print "First detection after %.1fs (expected %.1fs)" \
+				% (actual_time, self.expected_time)
+
+# Self-check: ./search_planner.py
+if __name__ == "__main__":
+	import random, tempfile
+
+	prior_file = os.path.join(tempfile.mkdtemp(), "search_prior.json")
+	random.seed(1)
+	for run in range(500):
+		planner = SearchPlanner(15, prior_file)
+		for index in range(random.randint(0, 10)):
+			planner.record_found(random.uniform(0, 15))
+
+		assert planner.plan(0) == [("left", 15)]
+		assert planner.plan(15) == [("right", 15)]
+		# the estimate can't be later than the end of the sweep
+		assert 0 <= planner.expected_time <= 15 + planner.stop_overhead
+
+		# from anywhere, the plan passes over the whole range (legs
+		# shorter than 0.05s are left out)
+		position = start = random.uniform(0, 15)
+		seen_lo = seen_hi = position
+		legs = planner.plan(position)
+		for direction, duration in legs:
+			position += duration if direction == "left" else -duration
+			seen_lo = min(seen_lo, position)
+			seen_hi = max(seen_hi, position)
+		assert seen_lo <= 0.05 and seen_hi >= 15 - 0.05, (start, legs)
+	print "ok"